@@ -4,17 +4,51 @@ Backend proxy para Port Forward de ArgoCD Extension
 Permite hacer port-forward a pods desde la UI de ArgoCD
 """
 
+import collections
+import heapq
+import html
+import itertools
 import os
+import random
+import re
+import secrets
+import selectors
+import shutil
+import socket
+import socketserver
 import subprocess
 import threading
 import time
 import logging
-from flask import Flask, request, jsonify, render_template_string
-from flask_cors import CORS
-import uuid
+import orjson
+from flask import Flask, Response, request
 
 app = Flask(__name__)
-CORS(app)  # Permitir CORS para que ArgoCD pueda hacer peticiones
+
+# Permitir CORS para que ArgoCD pueda hacer peticiones
+_CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Authorization, Content-Type',
+}
+
+
+@app.after_request
+def _add_cors_headers(response):
+    """Agrega las cabeceras CORS fijas a las respuestas que no las traen"""
+    # Las respuestas precalculadas ya las traen y se comparten entre hilos,
+    # así que no se deben modificar
+    if 'Access-Control-Allow-Origin' not in response.headers:
+        response.headers.update(_CORS_HEADERS)
+    return response
+
+
+@app.before_request
+def _cors_preflight():
+    """Responde los preflight CORS sin llegar a las vistas"""
+    if request.method == 'OPTIONS':
+        return '', 204
+
 
 # Configurar logging
 logging.basicConfig(
@@ -23,118 +57,544 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Almacenar procesos de port-forward activos
-active_forwards = {}
-forward_lock = threading.Lock()
+# Almacenar procesos de port-forward activos, repartidos en shards con su
+# propio lock para que /forward, /stop y /status no compitan por uno global
+FORWARD_SHARDS = 16
+_forward_shards = [{} for _ in range(FORWARD_SHARDS)]
+_forward_locks = [threading.Lock() for _ in range(FORWARD_SHARDS)]
+
+# Los session ID son "<contador en hex>-<sufijo aleatorio>"; el contador
+# reparte las sesiones entre shards sin necesidad de hashear el ID
+_session_counter = itertools.count(1)
+
+# Vencimientos de los port-forwards: heap de (expires_at, session_id).
+# Un único hilo reaper espera sobre _deadline_cv hasta el próximo vencimiento.
+_deadlines = []
+_deadline_cv = threading.Condition()
+
+# Puertos locales 9000-9999: bitmap de 16 palabras de 64 bits (1 = ocupado)
+LOCAL_PORT_BASE = 9000
+LOCAL_PORT_COUNT = 1000
+_WORD_MASK = (1 << 64) - 1
+_port_bits = [0] * ((LOCAL_PORT_COUNT + 63) // 64)
+# Marcar como ocupados los bits sobrantes de la última palabra
+_port_bits[-1] = _WORD_MASK & ~((1 << (LOCAL_PORT_COUNT % 64 or 64)) - 1)
+_port_lock = threading.Lock()
+
+# pidfd, stdout y stderr de los procesos kubectl activos (data = (session_id,
+# stream), con stream None para el pidfd). Un único hilo espera sobre todos:
+# vacía las salidas de kubectl al log y limpia la sesión en cuanto el proceso
+# termina. Solo existen pidfds en Linux, donde DefaultSelector es epoll.
+_process_sel = selectors.DefaultSelector()
+# Ese hilo es el único que desregistra y cierra esos fds, para que nunca lea
+# un número de fd ya cerrado y reutilizado por otro socket. Los demás hilos le
+# pasan (process, pidfd) por _released_processes y lo despiertan con _wakeup_w.
+_released_processes = collections.deque()
+_wakeup_r, _wakeup_w = os.pipe()
+os.set_blocking(_wakeup_r, False)
+os.set_blocking(_wakeup_w, False)
+_process_sel.register(_wakeup_r, selectors.EVENT_READ, None)
 
 # Configuración
 ARGOCD_SERVER_URL = os.environ.get('ARGOCD_SERVER_URL', 'https://argocd.devops.cetraro.io')
 FORWARD_TIMEOUT = int(os.environ.get('FORWARD_TIMEOUT', '3600'))  # 1 hora por defecto
 KUBECTL_NAMESPACE = os.environ.get('KUBECTL_NAMESPACE', 'argocd')
+# 'kubectl' lanza un proceso por port-forward; 'client' usa el cliente Python de Kubernetes
+PORT_FORWARD_BACKEND = os.environ.get('PORT_FORWARD_BACKEND', 'kubectl')
+# Resolver kubectl una sola vez en vez de recorrer el PATH en cada exec
+KUBECTL_BIN = shutil.which('kubectl') or '/usr/local/bin/kubectl'
+
+# Nombres válidos en Kubernetes: los namespaces son etiquetas DNS-1123 y los
+# pods subdominios DNS-1123. Se validan antes de pasarlos a kubectl.
+_K8S_LABEL = r'[a-z0-9]([-a-z0-9]{0,61}[a-z0-9])?'
+_NAMESPACE_RE = re.compile(_K8S_LABEL)
+_POD_NAME_RE = re.compile(rf'{_K8S_LABEL}(\.{_K8S_LABEL})*')
 
-logger.info(f"Backend iniciado. ArgoCD URL: {ARGOCD_SERVER_URL}, Timeout: {FORWARD_TIMEOUT}s")
+# Tiempo máximo de espera para que kubectl confirme que el port-forward está escuchando
+STARTUP_PROBE_TIMEOUT = 1.0
+
+# Caché de (namespace, pod) que fallaron hace poco, para no relanzar kubectl
+# en cada reintento: valor = instante hasta el que se rechaza directamente
+FAILED_FORWARD_TTL = 10
+FAILED_FORWARD_MAX = 256
+# Probabilidad de ignorar un acierto y reintentar igual, por si el fallo era transitorio
+FAILED_FORWARD_FORGET = 0.1
+_failed_forwards = {}
+_failed_lock = threading.Lock()
+
+logger.info("Backend iniciado. ArgoCD URL: %s, Timeout: %ss, Backend: %s", ARGOCD_SERVER_URL, FORWARD_TIMEOUT, PORT_FORWARD_BACKEND)
+logger.info("kubectl: %s", KUBECTL_BIN)
+
+# Cliente de Kubernetes compartido para las llamadas REST del backend 'client'.
+# kubernetes.stream.portforward parchea temporalmente el ApiClient que recibe,
+# así que los streams nunca usan este cliente sino uno propio (_new_stream_api)
+_core_api = None
+_core_api_lock = threading.Lock()
+
+
+def _get_core_api():
+    """Devuelve el CoreV1Api compartido, creándolo la primera vez"""
+    global _core_api
+    with _core_api_lock:
+        if _core_api is None:
+            from kubernetes import client, config
+            try:
+                config.load_incluster_config()
+            except config.ConfigException:
+                config.load_kube_config()
+            _core_api = client.CoreV1Api()
+        return _core_api
+
+
+def _new_stream_api():
+    """Crea un CoreV1Api con su propio ApiClient para un único stream de port-forward"""
+    from kubernetes import client
+    # Asegura que la configuración ya esté cargada
+    _get_core_api()
+    return client.CoreV1Api(client.ApiClient())
+
+
+class _ForwardServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _ClientPortForward:
+    """Port-forward hecho con el cliente de Kubernetes.
+    
+    Escucha en local_port y abre un stream de port-forward contra el pod por
+    cada conexión entrante. Expone la parte de la interfaz de Popen que usa
+    el resto del backend (poll, terminate, wait, kill).
+    """
+    
+    def __init__(self, namespace: str, pod_name: str, pod_port: int, local_port: int):
+        from kubernetes.stream import portforward
+        api = _get_core_api()
+        # Falla rápido si el pod no existe o no hay permisos
+        api.read_namespaced_pod(pod_name, namespace)
+        
+        # Conexiones abiertas (socket local, PortForward), para cortarlas en terminate()
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+        self._terminated = False
+        forward = self
+        
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                stream_api = _new_stream_api()
+                try:
+                    self._forward(stream_api)
+                finally:
+                    stream_api.api_client.close()
+            
+            def _forward(self, stream_api):
+                pf = None
+                try:
+                    pf = portforward(
+                        stream_api.connect_get_namespaced_pod_portforward,
+                        pod_name, namespace, ports=str(pod_port)
+                    )
+                    remote = pf.socket(pod_port)
+                except Exception as e:
+                    logger.error("Error al abrir el port-forward a %s/%s:%s: %s", namespace, pod_name, pod_port, e)
+                    if pf is not None:
+                        pf.close()
+                    return
+                
+                connection = (self.request, pf)
+                with forward._connections_lock:
+                    if forward._terminated:
+                        remote.close()
+                        pf.close()
+                        return
+                    forward._connections.add(connection)
+                try:
+                    _pump(self.request, remote)
+                finally:
+                    with forward._connections_lock:
+                        forward._connections.discard(connection)
+                    remote.close()
+                    pf.close()
+        
+        self.server = _ForwardServer(('0.0.0.0', local_port), Handler)
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+    
+    def poll(self):
+        return None if self._thread.is_alive() else 0
+    
+    def terminate(self):
+        self.server.shutdown()
+        self.server.server_close()
+        # Cortar también las conexiones en curso; cada handler cierra sus
+        # sockets al salir de _pump
+        with self._connections_lock:
+            self._terminated = True
+            connections = list(self._connections)
+        for local, pf in connections:
+            try:
+                local.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            pf.close()
+    
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+        return self.poll()
+    
+    kill = terminate
+
+
+def _pump(local, remote):
+    """Copia bytes en ambos sentidos entre dos sockets hasta que uno se cierre"""
+    with selectors.DefaultSelector() as sel:
+        sel.register(local, selectors.EVENT_READ, remote)
+        sel.register(remote, selectors.EVENT_READ, local)
+        while True:
+            for key, _ in sel.select():
+                data = key.fileobj.recv(65536)
+                if not data:
+                    return
+                key.data.sendall(data)
+
+
+def _open_pidfd(process: subprocess.Popen):
+    """Abre un pidfd del proceso, o devuelve None si la plataforma no lo soporta"""
+    try:
+        return os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        return None
+
+
+def _wait_port_forward_ready(process: subprocess.Popen) -> bool:
+    """Espera a que kubectl quede escuchando o termine; devuelve True si sigue vivo"""
+    pidfd = _open_pidfd(process)
+    if pidfd is None:
+        # Sin pidfd (Python < 3.9 o no Linux): comprobación con sleep + poll
+        time.sleep(STARTUP_PROBE_TIMEOUT)
+        return process.poll() is None
+    
+    try:
+        with selectors.DefaultSelector() as sel:
+            # pidfd es legible cuando el proceso termina; kubectl escribe
+            # "Forwarding from ..." en stdout en cuanto empieza a escuchar
+            sel.register(pidfd, selectors.EVENT_READ)
+            sel.register(process.stdout.fileno(), selectors.EVENT_READ)
+            deadline = time.monotonic() + STARTUP_PROBE_TIMEOUT
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                ready = {key.fd for key, _ in sel.select(timeout=remaining)}
+                if pidfd in ready:
+                    process.wait()
+                    return False
+                if ready:
+                    # EOF en stdout significa que kubectl está terminando
+                    if not process.stdout.readline():
+                        process.wait()
+                        return False
+                    break
+    finally:
+        os.close(pidfd)
+    return process.poll() is None
 
 
 def start_port_forward(namespace: str, pod_name: str, pod_port: int, local_port: int) -> subprocess.Popen:
-    """Inicia un port-forward usando kubectl"""
+    """Inicia un port-forward usando kubectl o el cliente de Kubernetes"""
     try:
-        cmd = [
-            'kubectl', 'port-forward',
+        if PORT_FORWARD_BACKEND == 'client':
+            process = _ClientPortForward(namespace, pod_name, pod_port, local_port)
+            logger.info("Port-forward iniciado exitosamente: %s:%s -> localhost:%s", pod_name, pod_port, local_port)
+            return process
+        
+        cmd = (
+            KUBECTL_BIN, 'port-forward',
             f'pod/{pod_name}',
             f'{local_port}:{pod_port}',
             '-n', namespace,
             '--address', '0.0.0.0'  # Escuchar en todas las interfaces
-        ]
+        )
         
-        logger.info(f"Iniciando port-forward: {' '.join(cmd)}")
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Iniciando port-forward: %s", ' '.join(cmd))
+        # close_fds=True es imprescindible: bajo gunicorn el socket de escucha
+        # es heredable y kubectl lo mantendría abierto. En Linux, Python >= 3.10
+        # igualmente lanza el proceso con vfork sin duplicar la memoria.
         process = subprocess.Popen(
             cmd,
+            stdin=subprocess.DEVNULL,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            text=True
+            text=True,
+            close_fds=True
         )
         
-        # Esperar un momento para verificar que el proceso inició correctamente
-        time.sleep(1)
-        if process.poll() is not None:
+        # Verificar que el proceso inició correctamente
+        if not _wait_port_forward_ready(process):
             # El proceso terminó inmediatamente, hubo un error
             stderr = process.stderr.read() if process.stderr else "Unknown error"
-            logger.error(f"Error al iniciar port-forward: {stderr}")
+            logger.error("Error al iniciar port-forward: %s", stderr)
             return None
         
-        logger.info(f"Port-forward iniciado exitosamente: {pod_name}:{pod_port} -> localhost:{local_port}")
+        logger.info("Port-forward iniciado exitosamente: %s:%s -> localhost:%s", pod_name, pod_port, local_port)
         return process
         
     except Exception as e:
-        logger.error(f"Error al iniciar port-forward: {str(e)}", exc_info=True)
+        logger.error("Error al iniciar port-forward: %s", e, exc_info=True)
         return None
 
 
-def stop_port_forward(session_id: str):
-    """Detiene un port-forward"""
-    with forward_lock:
-        if session_id in active_forwards:
-            process = active_forwards[session_id]['process']
-            if process and process.poll() is None:
-                process.terminate()
+def _new_session_id() -> str:
+    """Genera un session ID único y difícil de adivinar"""
+    return f"{next(_session_counter):x}-{secrets.token_urlsafe(6)}"
+
+
+def _recently_failed(namespace: str, pod_name: str) -> bool:
+    """Indica si el port-forward a este pod falló hace menos de FAILED_FORWARD_TTL"""
+    key = (namespace, pod_name)
+    with _failed_lock:
+        expires_at = _failed_forwards.get(key)
+        if expires_at is None:
+            return False
+        if expires_at <= time.time() or random.random() < FAILED_FORWARD_FORGET:
+            del _failed_forwards[key]
+            return False
+        return True
+
+
+def _remember_failure(namespace: str, pod_name: str):
+    """Registra un port-forward fallido, descartando el más antiguo si la caché está llena"""
+    key = (namespace, pod_name)
+    with _failed_lock:
+        _failed_forwards.pop(key, None)
+        if len(_failed_forwards) >= FAILED_FORWARD_MAX:
+            del _failed_forwards[next(iter(_failed_forwards))]
+        _failed_forwards[key] = time.time() + FAILED_FORWARD_TTL
+
+
+def _shard_index(session_id: str) -> int:
+    """Shard de _forward_shards que corresponde a una sesión"""
+    try:
+        return int(session_id.partition('-')[0], 16) & (FORWARD_SHARDS - 1)
+    except ValueError:
+        # Un ID mal formado no existe en ningún shard; cualquiera sirve para buscarlo
+        return 0
+
+
+def _alloc_port():
+    """Reserva el puerto local libre más bajo; llamar con _port_lock tomado"""
+    for i, word in enumerate(_port_bits):
+        free = ~word & _WORD_MASK
+        if free:
+            lowest = free & -free
+            _port_bits[i] = word | lowest
+            return LOCAL_PORT_BASE + i * 64 + lowest.bit_length() - 1
+    return None
+
+
+def _free_port(local_port: int):
+    """Libera un puerto reservado con _alloc_port; llamar con _port_lock tomado"""
+    index = local_port - LOCAL_PORT_BASE
+    _port_bits[index // 64] &= ~(1 << (index % 64))
+
+
+def stop_port_forward(session_id: str) -> bool:
+    """Detiene un port-forward; devuelve False si la sesión no existía"""
+    shard = _shard_index(session_id)
+    # La entrada en _deadlines se descarta de forma perezosa en el reaper
+    with _forward_locks[shard]:
+        info = _forward_shards[shard].pop(session_id, None)
+    if info is None:
+        return False
+    
+    process = info['process']
+    pidfd = info['pidfd']
+    if pidfd is not None:
+        _release_process(process, pidfd)
+    
+    if process and process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    with _port_lock:
+        _free_port(info['local_port'])
+    logger.info("Port-forward %s detenido", session_id)
+    return True
+
+
+def _reap_expired_forwards():
+    """Hilo único que detiene los port-forwards cuyo timeout venció"""
+    while True:
+        with _deadline_cv:
+            while True:
+                if not _deadlines:
+                    _deadline_cv.wait()
+                    continue
+                remaining = _deadlines[0][0] - time.time()
+                if remaining <= 0:
+                    break
+                _deadline_cv.wait(timeout=remaining)
+            expired = []
+            now = time.time()
+            while _deadlines and _deadlines[0][0] <= now:
+                expired.append(heapq.heappop(_deadlines)[1])
+        
+        # Las sesiones ya detenidas manualmente no existen y se saltan
+        for session_id in expired:
+            if stop_port_forward(session_id):
+                logger.info("Port-forward %s expirado después de %ss", session_id, FORWARD_TIMEOUT)
+
+
+def _watch_process(session_id: str, process: subprocess.Popen, pidfd: int):
+    """Registra el pidfd y las salidas de kubectl en _process_sel"""
+    # Lecturas no bloqueantes: el watcher lee tras cada aviso sin saber cuánto hay
+    os.set_blocking(process.stdout.fileno(), False)
+    os.set_blocking(process.stderr.fileno(), False)
+    _process_sel.register(process.stdout.fileno(), selectors.EVENT_READ, (session_id, 'stdout'))
+    _process_sel.register(process.stderr.fileno(), selectors.EVENT_READ, (session_id, 'stderr'))
+    _process_sel.register(pidfd, selectors.EVENT_READ, (session_id, None))
+
+
+def _release_process(process: subprocess.Popen, pidfd: int):
+    """Pide al watcher que desregistre y cierre el pidfd y las salidas del proceso"""
+    _released_processes.append((process, pidfd))
+    try:
+        os.write(_wakeup_w, b'\0')
+    except BlockingIOError:
+        # El pipe está lleno: el watcher ya tiene un aviso pendiente
+        pass
+
+
+def _close_released_processes():
+    """Desregistra y cierra los fds liberados; solo se llama desde el watcher"""
+    while _released_processes:
+        process, pidfd = _released_processes.popleft()
+        for fd in (process.stdout.fileno(), process.stderr.fileno(), pidfd):
+            try:
+                _process_sel.unregister(fd)
+            except KeyError:
+                # La salida ya se desregistró al llegar a EOF
+                pass
+        os.close(pidfd)
+        process.stdout.close()
+        process.stderr.close()
+
+
+def _watch_forward_processes():
+    """Hilo único que vacía las salidas de kubectl y limpia las sesiones cuyo proceso terminó"""
+    while True:
+        stopped = set()
+        for key, _ in _process_sel.select():
+            if key.data is None:
+                # Aviso de _release_process; los fds se cierran al terminar el lote
+                try:
+                    while os.read(_wakeup_r, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                continue
+            session_id, stream = key.data
+            # Los fds solo se cierran fuera de este bucle, así que todas las
+            # claves del lote siguen siendo válidas; las de una sesión ya
+            # detenida en este lote simplemente se ignoran
+            if session_id in stopped:
+                continue
+            if stream is None:
+                # Marcar la sesión como muerta para los /status que ya tengan
+                # una copia de la entrada; stop_port_forward pide cerrar el
+                # pidfd y las salidas
+                shard = _shard_index(session_id)
+                with _forward_locks[shard]:
+                    info = _forward_shards[shard].get(session_id)
+                if info is not None:
+                    info['alive'] = False
+                stopped.add(session_id)
+                if stop_port_forward(session_id):
+                    logger.warning("Port-forward %s terminó inesperadamente", session_id)
+                continue
+            
+            try:
+                data = os.read(key.fd, 65536)
+            except BlockingIOError:
+                continue
+            if not data:
+                # EOF: kubectl está terminando y su pidfd se encarga de la limpieza
                 try:
-                    process.wait(timeout=5)
-                except subprocess.TimeoutExpired:
-                    process.kill()
-            del active_forwards[session_id]
-            logger.info(f"Port-forward {session_id} detenido")
+                    _process_sel.unregister(key.fd)
+                except KeyError:
+                    pass
+                continue
+            
+            # Vaciar los pipes evita que kubectl se bloquee cuando se llenan;
+            # solo se decodifica si el nivel se va a registrar
+            level = logging.WARNING if stream == 'stderr' else logging.DEBUG
+            if not logger.isEnabledFor(level):
+                continue
+            for line in data.decode(errors='replace').splitlines():
+                if line:
+                    logger.log(level, "pf[%s] %s", session_id, line)
+        
+        _close_released_processes()
+
 
+threading.Thread(target=_reap_expired_forwards, name='forward-reaper', daemon=True).start()
+threading.Thread(target=_watch_forward_processes, name='forward-process-watcher', daemon=True).start()
 
-# Template HTML para mostrar el port-forward
+
+# Template HTML para mostrar el port-forward; los campos se completan con
+# str.format_map
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html>
 <head>
-    <title>Port Forward - {{ pod_name }}</title>
+    <title>Port Forward - {pod_name}</title>
     <meta charset="utf-8">
     <style>
-        body {
+        body {{
             font-family: Arial, sans-serif;
             max-width: 800px;
             margin: 50px auto;
             padding: 20px;
             background-color: #f5f5f5;
-        }
-        .container {
+        }}
+        .container {{
             background: white;
             padding: 30px;
             border-radius: 8px;
             box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-        }
-        h1 {
+        }}
+        h1 {{
             color: #0DADEA;
             margin-top: 0;
-        }
-        .info {
+        }}
+        .info {{
             background: #e8f4f8;
             padding: 15px;
             border-radius: 4px;
             margin: 20px 0;
-        }
-        .info p {
+        }}
+        .info p {{
             margin: 5px 0;
-        }
-        .status {
+        }}
+        .status {{
             padding: 10px;
             border-radius: 4px;
             margin: 20px 0;
-        }
-        .status.success {
+        }}
+        .status.success {{
             background: #d4edda;
             color: #155724;
             border: 1px solid #c3e6cb;
-        }
-        .status.error {
+        }}
+        .status.error {{
             background: #f8d7da;
             color: #721c24;
             border: 1px solid #f5c6cb;
-        }
-        .link {
+        }}
+        .link {{
             display: inline-block;
             margin-top: 20px;
             padding: 12px 24px;
@@ -143,44 +603,65 @@ HTML_TEMPLATE = """
             text-decoration: none;
             border-radius: 4px;
             font-weight: bold;
-        }
-        .link:hover {
+        }}
+        .link:hover {{
             background: #0b9dd1;
-        }
+        }}
     </style>
 </head>
 <body>
     <div class="container">
         <h1>🔗 Port Forward</h1>
         <div class="info">
-            <p><strong>Pod:</strong> {{ pod_name }}</p>
-            <p><strong>Namespace:</strong> {{ namespace }}</p>
-            <p><strong>Port:</strong> {{ port }}</p>
-            <p><strong>Local Port:</strong> {{ local_port }}</p>
-        </div>
-        {% if status == 'error' %}
-        <div class="status error">
-            <strong>Error:</strong> {{ error }}
+            <p><strong>Pod:</strong> {pod_name}</p>
+            <p><strong>Namespace:</strong> {namespace}</p>
+            <p><strong>Port:</strong> {port}</p>
+            <p><strong>Local Port:</strong> {local_port}</p>
         </div>
-        {% else %}
         <div class="status success">
             <strong>✅ Port-forward activo</strong>
-            <p>Puedes acceder al pod en: <code>http://localhost:{{ local_port }}</code></p>
+            <p>Puedes acceder al pod en: <code>http://localhost:{local_port}</code></p>
         </div>
-        <a href="http://localhost:{{ local_port }}" target="_blank" class="link">
+        <a href="http://localhost:{local_port}" target="_blank" class="link">
             Abrir en nueva pestaña
         </a>
-        {% endif %}
     </div>
 </body>
 </html>
 """
 
 
+def _json(obj, status: int = 200) -> Response:
+    """Respuesta JSON serializada con orjson"""
+    return Response(orjson.dumps(obj), status=status, mimetype='application/json')
+
+
+class _EscapedFields(dict):
+    """Campos para str.format_map escapados como HTML; los que faltan quedan vacíos"""
+    
+    def __missing__(self, key):
+        return ''
+    
+    def __getitem__(self, key):
+        return html.escape(str(super().__getitem__(key)))
+
+
+def _render_page(**fields) -> Response:
+    """Completa HTML_TEMPLATE con los campos dados"""
+    return Response(HTML_TEMPLATE.format_map(_EscapedFields(fields)), mimetype='text/html')
+
+
+# Respuesta del health check precalculada: los probes de Kubernetes la piden
+# cada pocos segundos y nunca cambia
+_HEALTH_RESPONSE = Response(b'{"status":"healthy"}', status=200, mimetype='application/json')
+_HEALTH_RESPONSE.headers['Cache-Control'] = 'no-store'
+_HEALTH_RESPONSE.headers.update(_CORS_HEADERS)
+
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
-    return jsonify({"status": "healthy"}), 200
+    return _HEALTH_RESPONSE
 
 
 @app.route('/api/v1/extensions/pod-forward/forward', methods=['GET'])
@@ -193,67 +674,85 @@ def forward():
             # Permitir sin autenticación para pruebas, pero en producción deberías validar
             logger.warning("Petición sin autenticación")
         
-        # Obtener parámetros
+        # Obtener y validar parámetros antes de reservar nada
         namespace = request.args.get('namespace')
         pod_name = request.args.get('pod')
-        port = int(request.args.get('port', 8080))
-        
         if not namespace or not pod_name:
-            return jsonify({"error": "Faltan parámetros: namespace y pod son requeridos"}), 400
+            return _json({"error": "Faltan parámetros: namespace y pod son requeridos"}, status=400)
+        if not _NAMESPACE_RE.fullmatch(namespace):
+            return _json({"error": "Namespace inválido"}, status=400)
+        if len(pod_name) > 253 or not _POD_NAME_RE.fullmatch(pod_name):
+            return _json({"error": "Nombre de pod inválido"}, status=400)
+        try:
+            port = int(request.args.get('port', 8080))
+        except ValueError:
+            return _json({"error": "Puerto inválido"}, status=400)
+        if not 1 <= port <= 65535:
+            return _json({"error": "Puerto inválido"}, status=400)
+        
+        # Rechazar sin lanzar kubectl si este pod falló hace unos segundos
+        if _recently_failed(namespace, pod_name):
+            return _json({
+                "error": f"El port-forward a este pod falló hace menos de {FAILED_FORWARD_TTL}s, reintenta en unos segundos",
+                "namespace": namespace,
+                "pod": pod_name,
+                "port": port
+            }, status=503)
         
-        # Generar session ID y local port
-        session_id = str(uuid.uuid4())
-        local_port = 9000 + (hash(session_id) % 1000)  # Puerto entre 9000-9999
+        # Generar session ID y reservar local port
+        session_id = _new_session_id()
+        with _port_lock:
+            local_port = _alloc_port()
+        if local_port is None:
+            return _json({"error": "No hay puertos locales disponibles"}, status=503)
         
         # Iniciar port-forward
         process = start_port_forward(namespace, pod_name, port, local_port)
         
         if not process:
-            return render_template_string(
-                HTML_TEMPLATE,
-                pod_name=pod_name,
-                namespace=namespace,
-                port=port,
-                local_port=local_port,
-                status='error',
-                error='No se pudo iniciar el port-forward',
-                session_id=session_id
-            ), 500
+            with _port_lock:
+                _free_port(local_port)
+            _remember_failure(namespace, pod_name)
+            return _json({
+                "error": "No se pudo iniciar el port-forward",
+                "namespace": namespace,
+                "pod": pod_name,
+                "port": port
+            }, status=500)
         
-        # Guardar en active_forwards
-        with forward_lock:
-            active_forwards[session_id] = {
+        # Guardar en el shard de la sesión
+        pidfd = _open_pidfd(process) if isinstance(process, subprocess.Popen) else None
+        shard = _shard_index(session_id)
+        with _forward_locks[shard]:
+            _forward_shards[shard][session_id] = {
                 'process': process,
+                'pidfd': pidfd,
+                'alive': True,
                 'namespace': namespace,
                 'pod': pod_name,
                 'pod_port': port,
                 'local_port': local_port,
                 'started_at': time.time()
             }
+        if pidfd is not None:
+            _watch_process(session_id, process, pidfd)
         
-        # Programar timeout
-        def timeout_handler():
-            time.sleep(FORWARD_TIMEOUT)
-            stop_port_forward(session_id)
-            logger.info(f"Port-forward {session_id} expirado después de {FORWARD_TIMEOUT}s")
-        
-        timeout_thread = threading.Thread(target=timeout_handler, daemon=True)
-        timeout_thread.start()
+        # Programar timeout en el reaper
+        with _deadline_cv:
+            heapq.heappush(_deadlines, (time.time() + FORWARD_TIMEOUT, session_id))
+            _deadline_cv.notify()
         
         # Retornar página HTML con información
-        return render_template_string(
-            HTML_TEMPLATE,
+        return _render_page(
             pod_name=pod_name,
             namespace=namespace,
             port=port,
-            local_port=local_port,
-            status='success',
-            session_id=session_id
-        ), 200
+            local_port=local_port
+        )
         
     except Exception as e:
-        logger.error(f"Error en endpoint forward: {str(e)}", exc_info=True)
-        return jsonify({"error": str(e)}), 500
+        logger.error("Error en endpoint forward: %s", e, exc_info=True)
+        return _json({"error": str(e)}, status=500)
 
 
 @app.route('/api/v1/extensions/pod-forward/stop/<session_id>', methods=['POST'])
@@ -261,32 +760,55 @@ def stop_forward(session_id):
     """Detener un port-forward"""
     try:
         stop_port_forward(session_id)
-        return jsonify({"status": "stopped"}), 200
+        return _json({"status": "stopped"}, status=200)
     except Exception as e:
-        logger.error(f"Error al detener port-forward: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        logger.error("Error al detener port-forward: %s", e)
+        return _json({"error": str(e)}, status=500)
 
 
 @app.route('/api/v1/extensions/pod-forward/status', methods=['GET'])
 def status():
-    """Obtener estado de todos los port-forwards activos"""
-    with forward_lock:
-        status_list = []
-        for session_id, info in active_forwards.items():
-            process = info['process']
-            status_list.append({
-                'session_id': session_id,
-                'namespace': info['namespace'],
-                'pod': info['pod'],
-                'pod_port': info['pod_port'],
-                'local_port': info['local_port'],
-                'active': process.poll() is None if process else False,
-                'started_at': info['started_at']
-            })
-        return jsonify({"active_forwards": status_list}), 200
+    """Obtener estado de los port-forwards activos, paginado con ?limit= y ?offset="""
+    try:
+        limit = request.args.get('limit')
+        limit = int(limit) if limit is not None else None
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return _json({"error": "limit y offset deben ser enteros"}, status=400)
+    if offset < 0 or (limit is not None and limit < 0):
+        return _json({"error": "limit y offset no pueden ser negativos"}, status=400)
+    
+    # Copiar las entradas shard por shard (siempre en el mismo orden) y
+    # armar la respuesta sin locks; de los dicts de cada sesión solo cambia
+    # 'alive', una única vez de True a False
+    snapshot = []
+    for shard, lock in zip(_forward_shards, _forward_locks):
+        with lock:
+            snapshot.extend(shard.items())
+    
+    # Los shards no conservan el orden de creación; ordenar para que las
+    # páginas de limit/offset sean estables
+    snapshot.sort(key=lambda item: item[1]['started_at'])
+    total = len(snapshot)
+    end = None if limit is None else offset + limit
+    status_list = []
+    for session_id, info in snapshot[offset:end]:
+        process = info['process']
+        status_list.append({
+            'session_id': session_id,
+            'namespace': info['namespace'],
+            'pod': info['pod'],
+            'pod_port': info['pod_port'],
+            'local_port': info['local_port'],
+            # El watcher mantiene 'alive' de las sesiones con pidfd, sin poll()
+            'active': info['alive'] if info['pidfd'] is not None else (process.poll() is None if process else False),
+            'started_at': info['started_at']
+        })
+    return _json({"active_forwards": status_list, "total": total}, status=200)
 
 
 if __name__ == '__main__':
+    # Servidor de desarrollo; en el contenedor se usa gunicorn (gunicorn.conf.py)
     port = int(os.environ.get('PORT', 8080))
-    logger.info(f"Iniciando servidor en el puerto {port}")
+    logger.info("Iniciando servidor en el puerto %s", port)
     app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
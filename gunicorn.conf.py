@@ -0,0 +1,16 @@
+"""
+Configuración de gunicorn para el backend de Port Forward
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+
+# Un solo worker: los port-forwards activos, el bitmap de puertos y los hilos
+# reaper viven en memoria del proceso, así que tiene que haber una única copia
+workers = 1
+worker_class = 'gthread'
+threads = 16
+worker_connections = 1000
+keepalive = 5
+timeout = 30